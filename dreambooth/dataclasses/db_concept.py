@@ -34,6 +34,18 @@ class Concept(BaseModel):
         if input_dict is not None:
             self.load_params(input_dict)
 
+    @classmethod
+    def from_dict(cls, input_dict: Dict):
+        """
+        Build a concept straight from a dict of field values with construct(), skipping the
+        default-field __init__ pass and the per-key setattr of load_params. Unknown keys are
+        dropped. Like load_params, this does not validate or coerce the values.
+        """
+        fields = cls.__fields__
+        concept = cls.construct(**{k: v for k, v in input_dict.items() if k in fields})
+        concept.check_instance_dir()
+        return concept
+
     def to_dict(self):
         return self.dict()
 
@@ -41,9 +53,13 @@ class Concept(BaseModel):
         return json.dumps(self.to_dict())
 
     def load_params(self, params_dict):
+        fields = self.__fields__
         for key, value in params_dict.items():
-            if hasattr(self, key):
+            if key in fields:
                 setattr(self, key, value)
+        self.check_instance_dir()
+
+    def check_instance_dir(self):
         if self.instance_data_dir:
             self.is_valid = os.path.isdir(self.instance_data_dir)
             if not self.is_valid:
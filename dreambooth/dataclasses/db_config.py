@@ -1,28 +1,138 @@
+import copy
 import datetime
+import functools
 import json
 import logging
 import os
-import traceback
-from pathlib import Path
-from typing import List, Dict
+import re
+import tempfile
+from collections import OrderedDict
+from typing import List, Dict, Tuple
 
 from pydantic import BaseModel
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from dreambooth import shared  # noqa
 from dreambooth.dataclasses.db_concept import Concept  # noqa
 from dreambooth.dataclasses.ss_model_spec import build_metadata
 from dreambooth.utils.image_utils import get_scheduler_names  # noqa
 from dreambooth.utils.utils import list_attention, select_precision, select_attention
 
+logger = logging.getLogger(__name__)
+
+# The umask can only be read by setting it, so do that once at import
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
 # Keys to save, replacing our dumb __init__ method
 save_keys = []
 
 # Keys to return to the ui when Load Settings is clicked.
 ui_keys = []
 
+# Configs loaded by from_file(), config_file: (st_mtime_ns, config), least recently used first
+_config_cache: "OrderedDict[str, Tuple[int, DreamboothConfig]]" = OrderedDict()
+_CONFIG_CACHE_SIZE = 32
+# Bumped by every save(), so a load that raced a save doesn't cache what it read before the write
+_config_generation = 0
+
+# DreamboothConfig attribute -> kohya-ss metadata key, used by export_ss_metadata()
+SS_METADATA_KEYS = {
+    'cache_latents': 'ss_cache_latents',
+    'clip_skip': 'ss_clip_skip',
+    'epoch': 'ss_epoch',
+    'gradient_accumulation_steps': 'ss_gradient_accumulation_steps',
+    'gradient_checkpointing': 'ss_gradient_checkpointing',
+    'learning_rate': 'ss_learning_rate',
+    'lr_scheduler': 'ss_lr_scheduler',
+    'lr_warmup_steps': 'ss_lr_warmup_steps',
+    'max_token_length': 'ss_max_token_length',
+    'min_snr_gamma': 'ss_min_snr_gamma',
+    'mixed_precision': 'ss_mixed_precision',
+    'optimizer': 'ss_optimizer',
+    'prior_loss_weight': 'ss_prior_loss_weight',
+    'resolution': 'ss_resolution',
+    'src': 'ss_sd_model_name',
+    'shuffle_tags': 'ss_shuffle_captions'
+}
+
+# Params renamed since older configs were saved, "old_key": "new_key"
+REPLACED_KEYS = {
+    "deis_train_scheduler": "noise_scheduler",
+}
+
+# Param values migrated since older configs were saved, ("old_key", old_value): new_value
+REPLACED_VALUES = {
+    ("deis_train_scheduler", True): "DDPM",
+    ("optimizer", "8Bit Adam"): "8bit AdamW",
+    ("save_safetensors", False): True,
+}
+REPLACED_VALUE_KEYS = frozenset(key for key, _ in REPLACED_VALUES)
+
+# Anything other than alphanumerics and "._- " (\w matches exactly str.isalnum() plus "_")
+SANITIZE_NAME_RE = re.compile(r"[^\w.\- ]")
+
+
+@functools.lru_cache(maxsize=1)
+def _scheduler_names():
+    # The diffusers scheduler enum doesn't change at runtime, so build the lookups once
+    schedulers = get_scheduler_names()
+    return frozenset(schedulers), tuple((scheduler.lower(), scheduler) for scheduler in schedulers)
+
+
+def _json_dumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=4).encode("utf-8")
+
+
+def _json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _read_json_file(path):
+    # Unbuffered: read() of a raw file sizes itself from fstat and fetches the whole file in one go
+    with open(path, "rb", buffering=0) as json_file:
+        return _json_loads(json_file.read())
+
+
+@functools.lru_cache(maxsize=128)
+def _config_file_path(models_path: str, model_name: str) -> str:
+    # Keyed on the models root itself, so a changed dreambooth_models_path simply misses
+    return os.path.join(models_path, model_name, "db_config.json")
+
+
+def _normalize_model_name(model_name):
+    """
+    Model names arrive as a str, a list from a dropdown, "" or None. Return the name, or None if there isn't one.
+    """
+    if isinstance(model_name, list):
+        model_name = model_name[0] if model_name else None
+    return model_name or None
+
+
+def _resolve_models_path():
+    """
+    Get the directory dreambooth models are stored in.
+    If we're using the new UI, shared.paths is populated, so load models from there.
+    Otherwise use shared.dreambooth_models_path, falling back to <models>/dreambooth.
+    """
+    if len(shared.paths):
+        return os.path.join(shared.paths["models"], "dreambooth")
+    models_path = shared.dreambooth_models_path
+    if models_path == "" or models_path is None:
+        models_path = os.path.join(shared.models_path, "dreambooth")
+    return models_path
+
 
 def sanitize_name(name):
-    return "".join(x for x in name if (x.isalnum() or x in "._- "))
+    return SANITIZE_NAME_RE.sub("", name)
 
 
 class DreamboothConfig(BaseModel):
@@ -130,7 +240,7 @@ class DreamboothConfig(BaseModel):
     use_ema: bool = True
     use_lora: bool = False
     use_lora_extended: bool = False
-    use_shared_src: bool = False,
+    use_shared_src: bool = False
     use_subdir: bool = False
     v2: bool = False
 
@@ -144,26 +254,20 @@ class DreamboothConfig(BaseModel):
             **kwargs
     ):
 
-        super().__init__(**kwargs)
-
         model_name = sanitize_name(model_name)
         if "attention" not in kwargs:
-            self.attention = select_attention()
+            kwargs["attention"] = select_attention()
 
         if "mixed_precision" not in kwargs:
-            self.mixed_precision = select_precision()
+            kwargs["mixed_precision"] = select_precision()
 
         if "models_path" in kwargs:
-            models_path = kwargs["models_path"]
+            models_path = kwargs.pop("models_path")
             print(f"Using models path: {models_path}")
         else:
-            models_path = shared.dreambooth_models_path
-            if models_path == "" or models_path is None:
-                models_path = os.path.join(shared.models_path, "dreambooth")
+            models_path = _resolve_models_path()
 
-            # If we're using the new UI, this should be populated, so load models from here.
-            if len(shared.paths):
-                models_path = os.path.join(shared.paths["models"], "dreambooth")
+        super().__init__(**kwargs)
 
         if not self.use_lora:
             self.lora_model_name = ""
@@ -171,16 +275,19 @@ class DreamboothConfig(BaseModel):
         # print(f"Model dir set to: {model_dir}")
         working_dir = os.path.join(model_dir, "working")
 
-        if not os.path.exists(working_dir):
-            os.makedirs(working_dir)
-
-        self.model_name = model_name
-        self.model_dir = model_dir
-        self.pretrained_model_name_or_path = working_dir
-        self.resolution = resolution
-        self.src = src
-        self.scheduler = "ddim"
-        self.v2 = v2
+        os.makedirs(working_dir, exist_ok=True)
+
+        # The named parameters never reach super().__init__(), so set them here, in one go rather than
+        # through pydantic's __setattr__ per attribute.
+        self.__dict__.update(
+            model_name=model_name,
+            model_dir=model_dir,
+            pretrained_model_name_or_path=working_dir,
+            resolution=resolution,
+            src=src,
+            scheduler="ddim",
+            v2=v2,
+        )
 
     # Actually save as a file
     def save(self, backup=False):
@@ -188,100 +295,96 @@ class DreamboothConfig(BaseModel):
         Save the config file
         """
         models_path = self.model_dir
-        logger = logging.getLogger(__name__)
         logger.debug("Saving to %s", models_path)
 
-        if os.name == 'nt' and '/' in models_path:
-            # replace linux path separators with windows path separators
-            models_path = models_path.replace('/', '\\')
-        elif os.name == 'posix' and '\\' in models_path:
-            # replace windows path separators with linux path separators
+        if os.name == 'posix':
+            # replace windows path separators with linux path separators, normpath only does the reverse
             models_path = models_path.replace('\\', '/')
+        models_path = os.path.normpath(models_path)
         self.model_dir = models_path
         config_file = os.path.join(models_path, "db_config.json")
 
         if backup:
             backup_dir = os.path.join(models_path, "backups")
-            if not os.path.exists(backup_dir):
-                os.makedirs(backup_dir)
-            config_file = os.path.join(models_path, "backups", f"db_config_{self.revision}.json")
-
-        with open(config_file, "w") as outfile:
-            json.dump(self.__dict__, outfile, indent=4)
-
-    def load_params(self, params_dict):
+            os.makedirs(backup_dir, exist_ok=True)
+            config_file = os.path.join(backup_dir, f"db_config_{self.revision}.json")
+
+        # Serialize first, then write a uniquely named temp file next to the target and swap it in, so
+        # concurrent saves of the same model don't collide and a failed save can't leave a truncated config
+        config_data = _json_dumps(self.__dict__)
+        config_dir, config_name = os.path.split(config_file)
+        fd, tmp_file = tempfile.mkstemp(dir=config_dir, prefix=f"{config_name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as outfile:
+                outfile.write(config_data)
+            # mkstemp creates the file as 0600, give it the mode the config has (or would get from open())
+            try:
+                mode = os.stat(config_file).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o666 & ~_UMASK
+            os.chmod(tmp_file, mode)
+            os.replace(tmp_file, config_file)
+        except BaseException:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+            raise
+        if not backup:
+            # mtime granularity can be coarse, so don't rely on it to notice our own writes
+            global _config_generation
+            _config_generation += 1
+            _config_cache.clear()
+
+    def load_params(self, params_dict, trusted=False):
+        """
+        Update the config from a dict of params
+        Args:
+            params_dict: The params to load, UI keys ("db_" prefixed) are accepted
+            trusted: The dict was read back from our own db_config.json, so skip pydantic's
+                per-attribute __setattr__ and write the migrated values straight to __dict__
+        """
         sched_swap = False
+        loaded = {}
+        fields = self.__fields__
         for key, value in params_dict.items():
-            if "db_" in key:
-                key = key.replace("db_", "")
+            if key.startswith("db_"):
+                key = key[3:]
             if key == "attention" and value == "flash_attention":
                 value = list_attention()[-1]
                 print(f"Replacing flash attention in config to {value}")
 
             if key == "scheduler":
-                schedulers = get_scheduler_names()
+                schedulers, schedulers_lower = _scheduler_names()
                 if value not in schedulers:
                     sched_swap = True
-                    for scheduler in schedulers:
-                        if value.lower() in scheduler.lower():
+                    value_lower = value.lower()
+                    for scheduler_lower, scheduler in schedulers_lower:
+                        if value_lower in scheduler_lower:
                             print(f"Updating scheduler name to: {scheduler}")
                             value = scheduler
                             break
 
-            if hasattr(self, key):
+            if key in fields:
                 key, value = self.validate_param(key, value)
-                setattr(self, key, value)
+                if trusted:
+                    loaded[key] = value
+                else:
+                    setattr(self, key, value)
+        if loaded:
+            self.__dict__.update(loaded)
         if sched_swap:
             self.save()
 
     @staticmethod
     def validate_param(key, value):
-        replaced_params = {
-            # "old_key" : {
-            #   "new_key": "...",
-            #   "values": [{
-            #       "old": ["...", "..."]
-            #       "new": "..."
-            #   }]
-            # }
-            "weight_decay": {
-                "new_key": "weight_decay",
-            },
-            "deis_train_scheduler": {
-                "new_key": "noise_scheduler",
-                "values": [{
-                    "old": [True],
-                    "new": "DDPM"
-                }],
-            },
-            "optimizer": {
-                "values": [{
-                    "old": ["8Bit Adam"],
-                    "new": "8bit AdamW"
-                }],
-            },
-            "save_safetensors": {
-                "values": [{
-                    "old": [False],
-                    "new": True
-                }],
-            }
-        }
-
-        if key in replaced_params.keys():
-            replacement = replaced_params[key]
-            if "new_key" in replacement:
-                key = replacement["new_key"]
-            if "values" in replacement:
-                for _value in replacement["values"]:
-                    if value in _value["old"]:
-                        value = _value["new"]
-        return key, value
+        new_key = REPLACED_KEYS.get(key, key)
+        if key in REPLACED_VALUE_KEYS:
+            value = REPLACED_VALUES.get((key, value), value)
+        return new_key, value
 
     # Pass a dict and return a list of Concept objects
     def concepts(self, required: int = -1):
-        concepts = []
-        c_idx = 0
         # If using a file for concepts and not requesting from UI, load from file
         if self.use_concepts and self.concepts_path and required == -1:
             concepts_list = concepts_from_file(self.concepts_path)
@@ -292,13 +395,10 @@ class DreamboothConfig(BaseModel):
         if required == -1:
             required = len(concepts_list)
 
-        for concept_dict in concepts_list:
-            concept = Concept(input_dict=concept_dict)
-            if concept.is_valid:
-                if concept.class_data_dir == "" or concept.class_data_dir is None:
-                    concept.class_data_dir = os.path.join(self.model_dir, f"classifiers_{c_idx}")
-                concepts.append(concept)
-                c_idx += 1
+        concepts = [concept for concept in map(Concept.from_dict, concepts_list) if concept.is_valid]
+        for c_idx, concept in enumerate(concepts):
+            if not concept.class_data_dir:
+                concept.class_data_dir = os.path.join(self.model_dir, f"classifiers_{c_idx}")
 
         missing = len(concepts) - required
         if missing > 0:
@@ -310,19 +410,14 @@ class DreamboothConfig(BaseModel):
         Reload self from file
 
         """
-        models_path = shared.dreambooth_models_path
-        if models_path == "" or models_path is None:
-            models_path = os.path.join(shared.models_path, "dreambooth")
-        config_file = os.path.join(models_path, self.model_name, "db_config.json")
+        config_file = _config_file_path(_resolve_models_path(), self.model_name)
         try:
-            with open(config_file, 'r') as openfile:
-                config_dict = json.load(openfile)
+            config_dict = _read_json_file(config_file)
 
-            self.load_params(config_dict)
+            self.load_params(config_dict, trusted=True)
             shared.db_model_config = self
-        except Exception as e:
-            print(f"Exception loading config: {e}")
-            traceback.print_exc()
+        except Exception:
+            logger.exception(f"Exception loading config: {config_file}")
             return None
 
     def get_pretrained_model_name_or_path(self):
@@ -360,25 +455,7 @@ class DreamboothConfig(BaseModel):
             buckets=bucket_counts,
             clip_skip=self.clip_skip
         )
-        mappings =  {
-            'cache_latents': 'ss_cache_latents',
-            'clip_skip': 'ss_clip_skip',
-            'epoch': 'ss_epoch',
-            'gradient_accumulation_steps': 'ss_gradient_accumulation_steps',
-            'gradient_checkpointing': 'ss_gradient_checkpointing',
-            'learning_rate': 'ss_learning_rate',
-            'lr_scheduler': 'ss_lr_scheduler',
-            'lr_warmup_steps': 'ss_lr_warmup_steps',
-            'max_token_length': 'ss_max_token_length',
-            'min_snr_gamma': 'ss_min_snr_gamma',
-            'mixed_precision': 'ss_mixed_precision',
-            'optimizer': 'ss_optimizer',
-            'prior_loss_weight': 'ss_prior_loss_weight',
-            'resolution': 'ss_resolution',
-            'src': 'ss_sd_model_name',
-            'shuffle_tags': 'ss_shuffle_captions'
-        }
-        for key, value in mappings.items():
+        for key, value in SS_METADATA_KEYS.items():
             if hasattr(self, key):
                 if value == "ss_resolution":
                     res = getattr(self, key)
@@ -423,59 +500,64 @@ class DreamboothConfig(BaseModel):
 
 def concepts_from_file(concepts_path: str):
     concepts = []
-    if os.path.exists(concepts_path) and os.path.isfile(concepts_path):
-        try:
-            with open(concepts_path, "r") as concepts_file:
-                concepts_str = concepts_file.read()
-        except Exception as e:
-            print(f"Exception opening concepts file: {e}")
-    else:
-        concepts_str = concepts_path
-
+    mtime = os.path.getmtime(concepts_path) if os.path.isfile(concepts_path) else None
     try:
-        concepts_data = json.loads(concepts_str)
-        for concept_data in concepts_data:
-            concepts_path_dir = Path(concepts_path).parent # Get which folder is JSON file reside
-            instance_data_dir = concept_data.get("instance_data_dir")
-            if not os.path.isabs(instance_data_dir):
-                print(f"Rebuilding portable concepts path: {concepts_path_dir} + {instance_data_dir}")
-                concept_data["instance_data_dir"] = os.path.join(concepts_path_dir, instance_data_dir)
-
-            concept = Concept(input_dict=concept_data)
-            if concept.is_valid:
-                concepts.append(concept.__dict__)
+        concepts_data = _load_concepts_data(concepts_path, mtime)
+        concepts = [vars(concept) for concept in map(Concept, concepts_data) if concept.is_valid]
     except Exception as e:
         print(f"Exception parsing concepts: {e}")
     print(f"Loaded concepts: {concepts}")
     return concepts
 
 
+@functools.lru_cache(maxsize=32)
+def _load_concepts_data(concepts_path: str, mtime):
+    """
+    Parse a concepts file (or a JSON string) and rebuild portable instance paths.
+    The mtime is only part of the cache key, so an edited file is parsed again.
+    Callers must treat the returned dicts as read-only.
+    """
+    if mtime is not None:
+        concepts_data = _read_json_file(concepts_path)
+    else:
+        concepts_data = _json_loads(concepts_path)
+    concepts_path_dir = os.path.dirname(os.path.abspath(concepts_path))  # Get which folder is JSON file reside
+    isabs = os.path.isabs
+    join = os.path.join
+    for concept_data in concepts_data:
+        instance_data_dir = concept_data.get("instance_data_dir")
+        if not isabs(instance_data_dir):
+            print(f"Rebuilding portable concepts path: {concepts_path_dir} + {instance_data_dir}")
+            concept_data["instance_data_dir"] = join(concepts_path_dir, instance_data_dir)
+    return tuple(concepts_data)
+
+
 def save_config(*args):
     params = list(args)
     concept_keys = ["c1_", "c2_", "c3_", "c4_"]
     params_dict = dict(zip(save_keys, params))
-    concepts_list = []
     # If using a concepts file/string, keep concepts_list empty.
     if params_dict["db_use_concepts"] and params_dict["db_concepts_path"]:
         concepts_list = []
         params_dict["concepts_list"] = concepts_list
     else:
-        for concept_key in concept_keys:
-            concept_dict = {}
-            for key, param in params_dict.items():
-                if concept_key in key and param is not None:
-                    concept_dict[key.replace(concept_key, "")] = param
-            concept_test = Concept(concept_dict)
-            if concept_test.is_valid:
-                concepts_list.append(concept_test.__dict__)
-        existing_concepts = params_dict["concepts_list"] if "concepts_list" in params_dict else []
-        if len(concepts_list) and not len(existing_concepts):
+        # Bucket the "cN_" prefixed UI params by concept in a single pass
+        concept_dicts = {concept_key: {} for concept_key in concept_keys}
+        for key, param in params_dict.items():
+            concept_dict = concept_dicts.get(key[:3])
+            if concept_dict is not None and param is not None:
+                concept_dict[key[3:]] = param
+        concepts_list = [vars(concept) for concept in map(Concept, concept_dicts.values()) if concept.is_valid]
+        existing_concepts = params_dict.get("concepts_list")
+        if concepts_list and not existing_concepts:
             params_dict["concepts_list"] = concepts_list
 
-    model_name = params_dict["db_model_name"]
-    if model_name is None or model_name == "":
+    model_name = _normalize_model_name(params_dict["db_model_name"])
+    if model_name is None:
         print("Invalid model name.")
         return
+    # load_params below copies db_model_name onto the config, so store the normalized name
+    params_dict["db_model_name"] = model_name
 
     config = from_file(model_name)
     if config is None:
@@ -485,20 +567,19 @@ def save_config(*args):
     config.save()
 
 
-def from_file(model_name, model_dir=None):
+def from_file(model_name, model_dir=None, set_active=True):
     """
     Load config data from UI
     Args:
         model_name: The config to load
         model_dir: If specified, override the default model directory
+        set_active: Make the loaded config shared.db_model_config. Pass False to just inspect a config.
 
     Returns: Dict | None
 
     """
-    if isinstance(model_name, list) and len(model_name) > 0:
-        model_name = model_name[0]
-
-    if model_name == "" or model_name is None:
+    model_name = _normalize_model_name(model_name)
+    if model_name is None:
         return None
 
     #model_name = sanitize_name(model_name)
@@ -506,19 +587,56 @@ def from_file(model_name, model_dir=None):
         models_path = model_dir
         shared.dreambooth_models_path = models_path
     else:
-        models_path = shared.dreambooth_models_path
-        if models_path == "" or models_path is None:
-            models_path = os.path.join(shared.models_path, "dreambooth")
-    config_file = os.path.join(models_path, model_name, "db_config.json")
-    try:
-        with open(config_file, 'r') as openfile:
-            config_dict = json.load(openfile)
+        models_path = _resolve_models_path()
 
-        config = DreamboothConfig(model_name)
-        config.load_params(config_dict)
+    config = _load_config(model_name, models_path)
+    if config is not None and set_active:
         shared.db_model_config = config
+    return config
+
+
+def _load_config(model_name: str, models_path: str):
+    """
+    Load a model's db_config.json from models_path without changing anything in dreambooth.shared.
+    Returns a fresh config the caller may modify, or None if there isn't a readable config.
+    """
+    config_file = _config_file_path(models_path, model_name)
+    generation = _config_generation
+    try:
+        mtime = os.stat(config_file).st_mtime_ns
+    except FileNotFoundError:
+        _config_cache.pop(config_file, None)
+        return None
+
+    cached = _config_cache.get(config_file)
+    if cached is not None and cached[0] == mtime:
+        _config_cache.move_to_end(config_file)
+        config = copy.deepcopy(cached[1])
+        # A cache hit skips DreamboothConfig.__init__, which is what (re)creates the working dir
+        os.makedirs(os.path.join(config.model_dir, "working"), exist_ok=True)
         return config
+
+    try:
+        config_dict = _read_json_file(config_file)
+    except (OSError, ValueError) as e:
+        print(f"Exception loading config: {e}")
+        logger.debug("Exception loading config %s", config_file, exc_info=True)
+        return None
+    if not isinstance(config_dict, dict):
+        print(f"Exception loading config: expected a JSON object in {config_file}")
+        return None
+
+    try:
+        config = DreamboothConfig(model_name)
+        config.load_params(config_dict, trusted=True)
     except Exception as e:
         print(f"Exception loading config: {e}")
-        traceback.print_exc()
+        logger.debug("Exception loading config %s", config_file, exc_info=True)
         return None
+    # Callers modify the config they get back, so only ever hand out copies of the cached one
+    if generation == _config_generation:
+        _config_cache[config_file] = (mtime, copy.deepcopy(config))
+        _config_cache.move_to_end(config_file)
+        while len(_config_cache) > _CONFIG_CACHE_SIZE:
+            _config_cache.popitem(last=False)
+    return config
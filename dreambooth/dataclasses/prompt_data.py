@@ -1,10 +1,12 @@
 import json
 import random
+import sys
 from dataclasses import dataclass, asdict
 from typing import Tuple
 
 
-@dataclass
+# slots= only exists on 3.10+, older interpreters just keep the per-instance __dict__
+@dataclass(**({"slots": True} if sys.version_info >= (3, 10) else {}))
 class PromptData:
     prompt: str = ""
     negative_prompt: str = ""
@@ -22,8 +24,7 @@ class PromptData:
         if self.seed == -1:
             self.seed = int(random.randrange(0, 21474836147))
 
-    @property
-    def __dict__(self):
+    def to_dict(self):
         """
         get a python dictionary
         """
@@ -34,4 +35,4 @@ class PromptData:
         """
         get the json formated string
         """
-        return json.dumps(self.__dict__)
+        return json.dumps(self.to_dict())
@@ -226,8 +226,9 @@ def generate_classifiers(
                 # Retrieve prompt data object
                 pd = prompts[i_idx]
                 if image_handler is not None:
-                    infer_settings = InferSettings(pd.__dict__)
-                    infer_settings.from_prompt_data(pd.__dict__)
+                    pd_dict = pd.to_dict()
+                    infer_settings = InferSettings(pd_dict)
+                    infer_settings.from_prompt_data(pd_dict)
                     image_filename = image_handler.save_image(image, pd.out_dir, infer_settings)
                     out_images.append(image_filename)
                 else:
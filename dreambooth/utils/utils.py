@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import functools
 import gc
 import html
 import importlib.util
@@ -114,6 +115,13 @@ def xformers_check():
 
 
 def list_optimizer():
+    return list(_probe_optimizers())
+
+
+# The optimizer/attention/precision probes import optional packages and query the device,
+# none of which changes while the process is running, so only do it once.
+@functools.lru_cache(maxsize=1)
+def _probe_optimizers():
     optimizer_list = ["Torch AdamW"]
     
     try:
@@ -218,24 +226,32 @@ def list_optimizer():
 
  
         
-    return optimizer_list
+    return tuple(optimizer_list)
 
 def list_attention():
+    return list(_probe_attention())
+
+@functools.lru_cache(maxsize=1)
+def _probe_attention():
     has_xformers = xformers_check()
     import diffusers.utils
 
     diffusers.utils.is_xformers_available = xformers_check
     if has_xformers:
-        return ["default", "xformers"]
+        return ("default", "xformers")
     else:
-        return ["default"]
+        return ("default",)
 
 def select_attention():
-    attentions = list_attention()
+    attentions = _probe_attention()
     # Return the last element
     return attentions[-1]
 
 def list_precisions():
+    return list(_probe_precisions())
+
+@functools.lru_cache(maxsize=1)
+def _probe_precisions():
     precisions = ["no", "fp16"]
     try:
         if torch.cuda.is_bf16_supported():
@@ -243,10 +259,10 @@ def list_precisions():
     except:
         pass
 
-    return precisions
+    return tuple(precisions)
 
 def select_precision():
-    precisions = list_precisions()
+    precisions = _probe_precisions()
     # Return the last element
     return precisions[-1]
 
@@ -248,7 +248,7 @@ class LogParser:
             from dreambooth.dataclasses.db_config import from_file  # noqa
         except:
             from core.modules.dreambooth.dreambooth.dataclasses.db_config import from_file # noqa
-        model_config = from_file(model_name)
+        model_config = from_file(model_name, set_active=False)
         print(f"Model name: {model_name}")
         if model_config is None:
             print("Unable to load model config!")